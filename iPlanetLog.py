@@ -2,10 +2,38 @@ __author__ = 'Jeffery.Smith'
 
 import re
 import time
+import timeit
 import StringIO
 import copy
 import logging
 import datetime
+import os
+import mmap
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import heapq
+import calendar
+import math
+import sys
+import gzip
+import bz2
+import threading
+import Queue
+import argparse
+import itertools
+import collections
+import json
+import hashlib
+import struct
+import tempfile
+import types
+import weakref
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class Error(Exception):
     def __init__(self,value):
@@ -37,10 +65,15 @@ class iPlanetLogField(object):
         self.name = values[1]
         self.end_delimiter = values[2]
         self.value = ""
-
+        self._regex_string = None
 
     @property
     def regex_string(self):
+        if self._regex_string is None:
+            self._regex_string = self._build_regex_string()
+        return self._regex_string
+
+    def _build_regex_string(self):
         #The format line claims that the content-type field is space delimited, but when the charset variable is
         #present, there is a space. So we just make a special check for this. Sucks, I know.
         if re.match(".+(content-type)", self.name):
@@ -59,15 +92,15 @@ class iPlanetLogField(object):
                                         self.end_delimiter)
         return pattern
 
-    def length(self):
-        if self.isempty():
-            spacing_offset = 1
-        else:
-            spacing_offset = len(self.value) + 1
+    @property
+    def continuation_regex_string(self):
+        #Matches the rest of a value that was cut short at an embedded delimiter, starting just past that delimiter
         if self.start_delimiter:
-            spacing_offset += 2
-        return spacing_offset
-
+            pattern = r'(.*?)%s\s' % self.escape(self.end_delimiter)
+        else:
+            pattern = r'([^%s]*)%s' % (self.escape(self.end_delimiter),
+                                       self.end_delimiter)
+        return pattern
 
     def escape(self,string):
         ESCAPE_DELIMITERS = ("[", "]", "(",")")
@@ -79,27 +112,265 @@ class iPlanetLogField(object):
         return self.name == 'Empty'
 
 
-class iPlanetLogRecord(object):
-    #Implemented an internal dictionary for field objects. This is for the as_string function which will perform
-    #faster than making repeated calls to getattr
+class _FixedOffset(datetime.tzinfo):
 
-    def __init__(self,fields=None,errors=None,private_to_public_names=None):
-        self._field_name_dict = {}
-        self.field_map = private_to_public_names
+    def __init__(self,minutes):
+        self._minutes = minutes
+        self._offset = datetime.timedelta(minutes=minutes)
+        sign = "-" if minutes < 0 else "+"
+        self._name = "%s%02d%02d" % (sign, abs(minutes) // 60, abs(minutes) % 60)
+
+    def utcoffset(self,dt):
+        return self._offset
+
+    def dst(self,dt):
+        return datetime.timedelta(0)
+
+    def tzname(self,dt):
+        return self._name
+
+    def __getinitargs__(self):
+        #tzinfo pickles by calling the class again with these
+        return (self._minutes,)
+
+
+class iPlanetLogDateDecoder(object):
+    #Turns the SYSDATE field (e.g. 17/Nov/2011:00:00:01 -0500) into (date, time, epoch, timestamp). Consecutive lines
+    #nearly always share the same second and always share the day, so both are kept in small caches that are
+    #emptied when they fill up. epoch and timestamp are None when the value can not be read.
+    MONTH_ABBREVIATIONS = {'Jan': '01', 'Feb': '02', 'Mar': '03', 'Apr': '04',
+                           'May': '05', 'Jun': '06', 'Jul': '07', 'Aug': '08',
+                           'Sep': '09', 'Oct': '10', 'Nov': '11', 'Dec': '12'}
+    TIME_PATTERN = re.compile('.+([0-9]{2}:[0-9]{2}:[0-9]{2}).+')
+    NOT_PRESENT = ("-", "-", None, None)
+
+    def __init__(self,cache_size=1024):
+        self.cache_size = cache_size
+        self._seconds = {}
+        self._days = {}
+        self._zones = {}
+
+    def decode(self,value):
+        try:
+            return self._seconds[value]
+        except KeyError:
+            pass
+        decoded = self._decode(value)
+        if len(self._seconds) >= self.cache_size:
+            self._seconds.clear()
+        self._seconds[value] = decoded
+        return decoded
+
+    def _decode(self,value):
+        day = self._decode_day(value[0:11])
+        if day is None:
+            return self.NOT_PRESENT
+        date_string, day_epoch, year, month, day_of_month = day
+        results = self.TIME_PATTERN.match(value)
+        if not results:
+            return date_string, "-", None, None
+        time_string = results.group(1)
+        try:
+            hour, minute, second = int(time_string[0:2]), int(time_string[3:5]), int(time_string[6:8])
+            zone = value[21:26]
+            minutes = int(zone[1:3]) * 60 + int(zone[3:5])
+            if zone[0] == '-':
+                minutes = -minutes
+            timestamp = datetime.datetime(year, month, day_of_month, hour, minute, second,
+                                          tzinfo=self._zone(minutes))
+        except (ValueError, IndexError):
+            return date_string, time_string, None, None
+        epoch = day_epoch + hour * 3600 + minute * 60 + second - minutes * 60
+        return date_string, time_string, epoch, timestamp
+
+    def _decode_day(self,value):
+        try:
+            return self._days[value]
+        except KeyError:
+            pass
+        try:
+            month = self.MONTH_ABBREVIATIONS[value[3:6]]
+            year, day_of_month = int(value[7:11]), int(value[0:2])
+            day_epoch = calendar.timegm((year, int(month), day_of_month, 0, 0, 0))
+        except (KeyError, ValueError):
+            return None
+        day = ("%s/%s/%s" % (month, value[0:2], value[7:11]), day_epoch, year, int(month), day_of_month)
+        if len(self._days) >= self.cache_size:
+            self._days.clear()
+        self._days[value] = day
+        return day
+
+    def _zone(self,minutes):
+        try:
+            return self._zones[minutes]
+        except KeyError:
+            zone = self._zones[minutes] = _FixedOffset(minutes)
+            return zone
+
+
+class iPlanetLogInterner(object):
+    #Hands back one shared copy of each value so records holding the same user agent, referer and so on do not each
+    #keep their own string. Values are kept in two generations: once the recent one fills up it becomes the older
+    #one and the previous older generation is dropped, so values not seen for a while are evicted and memory stays
+    #bounded by capacity.
+
+    def __init__(self,capacity=4096):
+        self.capacity = capacity
+        self._recent = {}
+        self._older = {}
+
+    def intern(self,value):
         try:
-            for field in fields:
-                if not field.name == self.value_not_present() and not field.isempty():
-                    public_field_name = private_to_public_names[field.name]
-                    setattr(self,public_field_name,field.value)
-                    self._field_name_dict[public_field_name] = field.value
-            self._separate_combined_fields()
+            return self._recent[value]
+        except KeyError:
+            pass
+        value = self._older.get(value, value)
+        if len(self._recent) >= self.capacity // 2:
+            self._older = self._recent
+            self._recent = {}
+        self._recent[value] = value
+        return value
+
+
+class iPlanetLogStats(object):
+    #What an iPlanetLogFile did besides matching lines in the first pass. Parse errors are counted by the field that
+    #could not be matched, and only the first few offending lines of each field are kept. At most log_limit errors
+    #are logged every log_interval seconds, with a count of the ones left out, so a log full of bad lines does not
+    #spend its time in logging. repair_depths counts repaired lines by how many times a field had to be grown
+    #through one of its own delimiters. The stage timers are only filled in for files opened with timing=True.
+    STAGES = ('read', 'first_pass', 'repair', 'record')
+
+    def __init__(self,sample_size=5,log_limit=10,log_interval=60.0):
+        self.sample_size = sample_size
+        self.log_limit = log_limit
+        self.log_interval = log_interval
+        self._interval_start = None
+        self._interval_logged = 0
+        self._interval_unlogged = 0
+        self._reset()
+
+    def _reset(self):
+        self.errors = 0
+        self.error_fields = {}
+        self.samples = {}
+        self.repair_depths = {}
+        self.timers = dict.fromkeys(self.STAGES, 0.0)
+        self.unlogged = 0
+
+    def add_repair(self,depth):
+        self.repair_depths[depth] = self.repair_depths.get(depth, 0) + 1
+
+    def add_error(self,field_name,line):
+        self.errors += 1
+        self.error_fields[field_name] = self.error_fields.get(field_name, 0) + 1
+        samples = self.samples.setdefault(field_name, [])
+        if len(samples) < self.sample_size:
+            samples.append(line)
+        now = time.time()
+        if self._interval_start is None or now - self._interval_start >= self.log_interval:
+            if self._interval_unlogged:
+                logging.error("%d more parsing errors were not logged", self._interval_unlogged)
+            self._interval_start = now
+            self._interval_logged = 0
+            self._interval_unlogged = 0
+        if self._interval_logged < self.log_limit:
+            self._interval_logged += 1
+            logging.error("Parsing Error at %s: %s", field_name, line)
+        else:
+            self._interval_unlogged += 1
+            self.unlogged += 1
+
+    def merge(self,other):
+        self.errors += other.errors
+        self.unlogged += other.unlogged
+        for name, count in other.error_fields.iteritems():
+            self.error_fields[name] = self.error_fields.get(name, 0) + count
+        for name, lines in other.samples.iteritems():
+            samples = self.samples.setdefault(name, [])
+            samples.extend(lines[:self.sample_size - len(samples)])
+        for depth, count in other.repair_depths.iteritems():
+            self.repair_depths[depth] = self.repair_depths.get(depth, 0) + count
+        for stage, seconds in other.timers.iteritems():
+            self.timers[stage] += seconds
+        return self
+
+    def drain(self):
+        #Hands back what has been counted so far and starts again from zero. The logging interval carries on, so
+        #the limit still holds across calls.
+        drained = iPlanetLogStats(self.sample_size, self.log_limit, self.log_interval).merge(self)
+        self._reset()
+        return drained
+
+    def as_dict(self):
+        return {'errors' : self.errors, 'error_fields' : dict(self.error_fields),
+                'samples' : dict((name, list(lines)) for name, lines in self.samples.iteritems()),
+                'repair_depths' : dict(self.repair_depths), 'timers' : dict(self.timers),
+                'unlogged' : self.unlogged}
+
+
+class iPlanetLogRecordLayout(object):
+    #Shared by every record parsed from the same file. Maps the public attribute names to their position in the
+    #match groups so the records themselves only need to hold a tuple of values.
+
+    def __init__(self,fields,private_to_public_names,header=None):
+        self.header = header
+        self.field_map = private_to_public_names
+        self.index = {}
+        for position, field in enumerate(fields):
+            if field.name == "-" or field.isempty():
+                continue
+            try:
+                self.index[private_to_public_names[field.name]] = position
+            except KeyError:
+                continue
+        self.public_names = [name for name in self.index if not name.startswith('_')]
+        self.date_decoder = iPlanetLogDateDecoder()
+
+
+class iPlanetLogRecord(object):
+    #Records are built straight from the regex match groups. The combined fields (date, time and the pieces of the
+    #request line) are only split out the first time they are asked for.
+    __slots__ = ('_values', '_layout', '_interner', '_decoded_date', '_request', '_url', '_query_string', '_version',
+                 'error', 'error_msg')
+
+    COMBINED_FIELDS = ('date','time','request','version','url','query_string')
+    REQUEST_PATTERNS = { 'request' : re.compile(r'([A-Za-z]+).+'), 'url' : re.compile('[A-Za-z]+\s([^\s|?]+)'),
+                         'query_string' : re.compile('.+\?([^\s]+)'), 'version' : re.compile('(HTTP[^\s]+)') }
+
+    def __init__(self,values=None,errors=None,layout=None,interner=None):
+        self._values = values
+        self._layout = layout
+        #When set, the request method and version are shared through it as they are split out
+        self._interner = interner
+        self._decoded_date = None
+        self._request = None
+        self._url = None
+        self._query_string = None
+        self._version = None
+        if values is None:
+            self.error = True
+            self.error_msg = errors
+        else:
             self.error = False
             self.error_msg = ""
-        except TypeError:
-            logging.error("%s Parsing Error: %s" % (str(datetime.datetime.now()), fields))
-            self.error = True
-            self.error_msg = fields
 
+    def __getattr__(self,name):
+        if name in ('_values', '_layout'):
+            raise AttributeError(name)
+        try:
+            return self._values[self._layout.index[name]]
+        except (KeyError, TypeError):
+            raise AttributeError(name)
+
+    def __reduce__(self):
+        #Only the values and the format header are pickled. The layout is found again through the format cache when
+        #the record is loaded.
+        header = self._layout.header if self._layout is not None else None
+        return _load_record, (header, self._values, self.error_msg)
+
+    @property
+    def field_map(self):
+        return self._layout.field_map
 
     def as_string(self,delimiter=" ",replace_spaces=False, ordered_output=None):
         string_output = []
@@ -107,9 +378,9 @@ class iPlanetLogRecord(object):
         for attribute in fields:
             if attribute.startswith('_'):
                 continue
-            value = self._field_name_dict[attribute]
+            value = self._get_value(attribute)
             if replace_spaces:
-                value = value.replace(" ","+")            
+                value = value.replace(" ","+")
             string_output.append("%s%s" % (value,delimiter))
         return "%s" % ''.join(string_output)
 
@@ -119,7 +390,7 @@ class iPlanetLogRecord(object):
         for attribute in fields:
             if attribute.startswith('_'):
                 continue
-            value = getattr(self,attribute)
+            value = self._get_value(attribute)
             if replace_spaces:
                 value.replace(" ", "+")
             return_dict[attribute] = value
@@ -128,185 +399,144 @@ class iPlanetLogRecord(object):
     def value_not_present(self):
         return "-"
 
+    def _get_value(self,attribute):
+        try:
+            return self._values[self._layout.index[attribute]]
+        except KeyError:
+            return getattr(self,attribute)
+
     def _get_property_names(self):
-        fields = self._field_name_dict.values()
-        for field in ('date','time','request','version','url','query_string'):
-            fields.append(field)
+        fields = list(self._layout.public_names)
+        fields.extend(self.COMBINED_FIELDS)
         return fields
 
     def _format_date_time(self):
-        new_date = ''
-        month_abbreviations = {'Jan': '01', 'Feb': '02', 'Mar': '03', 'Apr': '04',
-                               'May': '05', 'Jun': '06', 'Jul': '07', 'Aug': '08',
-                               'Sep': '09', 'Oct': '10', 'Nov': '11', 'Dec': '12'}
-        year = self._datetime[7:11]
-        month = self._datetime[3:6]
-        day = self._datetime[0:2]
-        new_date = "%s/%s/%s" % (month_abbreviations[month], day, year)
-        setattr(self,'date',new_date)
-        self._field_name_dict['date'] = new_date
+        if self._decoded_date is None:
+            if '_datetime' in self._layout.index:
+                self._decoded_date = self._layout.date_decoder.decode(self._datetime)
+            else:
+                self._decoded_date = iPlanetLogDateDecoder.NOT_PRESENT
+        return self._decoded_date
 
+    def _separate_combined_field(self,property):
         try:
-            value = re.match('.+([0-9]{2}:[0-9]{2}:[0-9]{2}).+',self._datetime).group(1)
-            self._field_name_dict['time'] = value
+            return self.REQUEST_PATTERNS[property].match(self._request_string).group(1)
         except AttributeError:
-            value = self.value_not_present()
-        self._field_name_dict['time'] = value
-        setattr(self,'time',self._field_name_dict['time'])
+            return self.value_not_present()
 
+    @property
+    def date(self):
+        return self._format_date_time()[0]
 
-    def _separate_combined_fields(self):
-        self._format_date_time()
-        value = ''
-        property_patterns = { 'request' : r'([A-Za-z]+).+', 'url' : '[A-Za-z]+\s([^\s|?]+)',
-                              'query_string' : '.+\?([^\s]+)','version' : '(HTTP[^\s]+)' }
+    @property
+    def time(self):
+        return self._format_date_time()[1]
 
-        for property, regex in property_patterns.iteritems():
-            try:
-                value = re.match(regex,self._request_string).group(1)
+    @property
+    def epoch(self):
+        #Seconds since 1970-01-01 UTC with the logged time zone applied, or None
+        return self._format_date_time()[2]
 
-            except AttributeError:
-                value = self.value_not_present()
-            finally:
-                self._field_name_dict[property] = value
-                setattr(self,property,value)
+    @property
+    def timestamp(self):
+        #Time zone aware datetime.datetime, or None
+        return self._format_date_time()[3]
 
     @property
-    def has_errors(self):
-        return self.error
+    def request(self):
+        if self._request is None:
+            self._request = self._separate_combined_field('request')
+            if self._interner is not None:
+                self._request = self._interner.intern(self._request)
+        return self._request
 
+    @property
+    def url(self):
+        if self._url is None:
+            self._url = self._separate_combined_field('url')
+        return self._url
 
-class iPlanetLogFile(object):
+    @property
+    def query_string(self):
+        if self._query_string is None:
+            self._query_string = self._separate_combined_field('query_string')
+        return self._query_string
 
-    def __init__(self,file):
-        self._file = file
-        self._fields = []
-        self._field_names = {}
-        self.chunk_size = 500
-        line = self._file.readline()
-        if "format=" in line:
-            line = line.replace("format=", "")
-        else:
-            raise TypeError("Log file does not have the proper header")
-        self._build_fields(line)
-        self.first_success = 0
-        self.rehash_success = 0
+    @property
+    def version(self):
+        if self._version is None:
+            self._version = self._separate_combined_field('version')
+            if self._interner is not None:
+                self._version = self._interner.intern(self._version)
+        return self._version
 
+    @property
+    def has_errors(self):
+        return self.error
 
-    def __iter__(self):
-        return self
 
-    def is_last_field(self,field):
-        return field.name == self._fields[-1].name and not field.isempty()
+def _load_record(header,values,error_msg):
+    if values is None:
+        return iPlanetLogRecord(errors=error_msg)
+    layout = iPlanetLogFormat.from_header(header).layout if header is not None else None
+    return iPlanetLogRecord(values=values, layout=layout)
 
-    @property
-    def fields(self):
-        fields_copy = copy.deepcopy(self._fields)
-        return fields_copy
 
-    @property
-    def paired_delimiters(self):
-        return { "(" : ")", "[" : "]", "<" : ">", "{" : "}"}
+class iPlanetLogBatch(object):
+    #Column oriented view of a run of log lines. Integer columns (status, content_length and epoch) are NumPy arrays
+    #when NumPy is installed and array.array otherwise, with -1 standing in for values that are missing or could not
+    #be read. String columns are plain lists. errors holds one flag per row.
+    INTEGER_COLUMNS = ('status', 'content_length', 'epoch')
 
-    def read(self):
-        data = self._file.next()
-        return data
+    def __init__(self,columns,data,errors):
+        self.columns = {}
+        for name, values in zip(columns, data):
+            if name in self.INTEGER_COLUMNS:
+                values = self._integer_array(values)
+            self.columns[name] = values
+        if numpy is not None:
+            self.errors = numpy.array(errors, dtype=bool)
+        else:
+            self.errors = array('b', errors)
 
-    def next(self):
-        line = self.read()
-        try:
-            return self._parse_log_line(line)
-        except FieldDelimiterError:
-            return self.parse_by_field(line)
+    def __len__(self):
+        return len(self.errors)
 
-    def _parse_log_line(self,line):
-        results = self.regex_object.match(line)
-        populated_fields = []
-        x = 1
-        if results:
-            for field in self.fields:
-                field.value = results.group(x)
-                populated_fields.append(field)
-                x += 1
-            self.first_success += 1
-            return iPlanetLogRecord(fields=populated_fields, private_to_public_names=self._field_names)
-        else:
-            raise FieldDelimiterError('Could not parse with single regex')
+    def __getitem__(self,name):
+        return self.columns[name]
 
-    def parse_by_field(self,line):
-        #This will go field by field in an attempt to parse the log. Sometimes we find the log entry does not match the
-        #field delimiter specified. (Like url strings not being encoded prior to being sent to the log, so occasionally
-        #an actual space character will show up, breaking the specified field format)
-        line = StringIO.StringIO(line)
-        offset = 0
-        populated_fields = []
-        for field in self.fields:
-            try:
-                field = self._extract_field(field,line,offset)
-            except FieldDelimiterError as ex:
-                try:
-                    previous_field = populated_fields[-1]
-                    previous_field_length = previous_field.length()
-                    repaired_fields = self.reprocess_previous_field(previous_field,field,line)
-                    populated_fields[-1] = repaired_fields['previous_field']
-                    field = repaired_fields['current_field']
-                    offset += (repaired_fields['previous_field'].length() - previous_field_length)
-                except FieldDelimiterError, IndexError:
-                    line.seek(0)
-                    return iPlanetLogRecord( errors=line.readline(), private_to_public_names=self._field_names )
-            populated_fields.append(field)
-            offset += field.length()
-        self.rehash_success += 1
-        return iPlanetLogRecord(fields=populated_fields, private_to_public_names=self._field_names)
+    def _integer_array(self,values):
+        if numpy is not None:
+            return numpy.array(values, dtype=numpy.int64)
+        return array('l', values)
 
-    def reprocess_previous_field(self,previous_field,current_field,line):
-        line.seek(0)
-        pattern = r'(.+?%s)' % re.escape(previous_field.value)
-        data = line.readline()
-        try:
-            offset = len(re.match(pattern,data ).group(1) ) + 1
-        except AttributeError:
-            raise FieldDelimiterError(data)
-
-        if offset > len(data):
-            raise LogFormatError(data)
-        dangling_field = copy.copy(previous_field)
-        dangling_field = self._extract_field(dangling_field,line,offset)
-        previous_field.value = ("%s%s%s") % (previous_field.value, previous_field.end_delimiter,
-                                             dangling_field.value)
-        offset += dangling_field.length()
-        try:
-            field = self._extract_field(current_field,line,offset)
-            current_field = field
-        except FieldDelimiterError as ex:
-            field = self.reprocess_previous_field(previous_field,current_field,line)
 
-        return { 'previous_field' :previous_field, 'current_field' :current_field }
+class iPlanetLogFormat(object):
+    #Everything that can be worked out from the format= header alone. Formats are cached by header for the life of
+    #the process, so opening another log written with a format we have already seen costs a dictionary lookup.
+    _cache = {}
 
+    def __init__(self,header):
+        self.header = header
+        self.fields = []
+        self.field_names = {}
+        self._build_fields(header)
+        self._build_regex_string()
+        self._build_field_lookup()
+        self.layout = iPlanetLogRecordLayout(self.fields, self.field_names, header)
 
-    def _extract_field(self,field,line, offset=0,chunk_size=None):
-        line.seek(0)
-        chunk_size = chunk_size or self.chunk_size
-        line.seek(offset)
-        data = line.read(chunk_size)
+    @classmethod
+    def from_header(cls,header):
         try:
-            field.value = re.match(field.regex_string,data).group(1)
-        except AttributeError:
-           # if data == '':
-           #     raise FieldDelimiterError('Matching Record Not found')
+            return cls._cache[header]
+        except KeyError:
+            log_format = cls(header)
+            cls._cache[header] = log_format
+            return log_format
 
-            if field.isempty():
-                field.value = ''
-            else:
-                if re.findall("\n", data):
-                    if self.is_last_field(field):
-                        field.value = data.rstrip()
-                    else:
-                        raise FieldDelimiterError("Line doesn't match format:\n %s" % re.match(r'(.+\n)', data).group(0))
-                else:
-                    chunk_size += chunk_size
-                    field = self._extract_field(field,line,offset=offset,chunk_size=chunk_size)
-        return field
+    @property
+    def paired_delimiters(self):
+        return { "(" : ")", "[" : "]", "<" : ">", "{" : "}"}
 
     def _build_fields(self,line):
         start = ""
@@ -329,7 +559,7 @@ class iPlanetLogFile(object):
                     character = line.read(1)
                     continue
             if character == end:
-                self._fields.append(iPlanetLogField(''.join(field), starting_character=start, ending_character=end))
+                self.fields.append(iPlanetLogField(''.join(field), starting_character=start, ending_character=end))
                 #Skip the space delimiter
                 x = line.read(1)
                 #Sometimes an extra space or two shows up in the header. The space is also
@@ -345,63 +575,1571 @@ class iPlanetLogFile(object):
             else:
                 field.append(character)
                 character = line.read(1)
-        self._build_regex_string()
-        self._build_field_lookup()
-
-    def field_to_attribute(self,field_name):
-        return self._field_names[field_name]
-
 
     def _build_field_lookup(self):
         expressions = {'clientip' : '.+client\.ip', 'user' : '.+auth-user', 'content_length' : '.+content-length',
                        'referer' : '.+referer', 'cookies' : '.+cookie', 'user_agent' : '.+user-agent',
                        '_datetime' : '.+SYSDATE', '_request_string' : '.+clf-request',
                        'status' : '.+clf-status', 'content_type' : '.+content-type' }
-        for field in self._fields:
+        for field in self.fields:
             for attribute, pattern in expressions.iteritems():
                 if re.match(pattern, field.name):
-                    self._field_names[field.name] = attribute
+                    self.field_names[field.name] = attribute
                     break
 
     def _build_regex_string(self):
         regex_string_list = []
-        for field in self._fields:
+        for field in self.fields:
             regex_string_list.append("%s" % field.regex_string)
         regex_string = r''.join(regex_string_list)
         self.regex_string = r'^(?:%s)' % regex_string
         self.regex_object = re.compile(self.regex_string)
+        self.field_patterns = [re.compile(field.regex_string) for field in self.fields]
+        self.continuation_patterns = [re.compile(field.continuation_regex_string) if not field.isempty() else None
+                                      for field in self.fields]
+        #'^' only matches at the real start of the buffer, so the mapped file gets a copy without it
+        self.buffer_regex_object = re.compile(r'(?:%s)' % regex_string)
 
-def main():
-    start = time.time()
-    file = "C:\\temp\\data\\access\\access.201111170000"
-    file = open(file,'r')
-    parser = iPlanetLogFile(file)
-    output_file = open('C:\\temp\\data\\access\\converted_output.txt', 'w')
-    error_count = 0
-    output_order = ('clientip','user','date','request','status','user_agent','time','url',
-        'query_string','cookies', 'referer')
-
-    output_file.write("#Software: Microsoft Internet Information Services 6.0\n")
-    output_file.write("#Version: 1.0\n")
-    output_file.write("#Fields: c-ip cs-username date cs-method sc-status cs(User-Agent) time cs-uri-stem cs-uri-query cs(Cookie) cs(Referer)\n")
-    write_buffer = []
-    for entry in parser:
-        if not entry.has_errors:
-            pass
-            write_buffer.append("%s\n" % entry.as_string(replace_spaces=True,ordered_output=output_order))
-            if len(write_buffer) > 100:
-                output_file.writelines(write_buffer)
-                write_buffer = []
+
+FIRST_PASS = 0
+REHASH = 1
+PARSE_ERROR = 2
+
+
+class iPlanetLogCacheWriter(object):
+    #Writes parsed lines to a compact binary cache. Lines are grouped into blocks and each block is stored a column
+    #at a time. A column of plain integers (status, content length) is packed as 64 bit integers. A repetitive
+    #column (user agent, referer, content type...) is stored as a table of its distinct values plus a small code
+    #per row. Anything else is stored as length prefixed strings. The footer records the source's size, mtime and
+    #header so a stale cache is never read. The cache is written under a unique temporary name, created with the
+    #first block, and only moved into place once the whole log has been read. A cache that can not be written is
+    #logged and given up on, it never stops the log itself from being read.
+    MAGIC = 'IPLC'
+    VERSION = 1
+    BLOCK_SIZE = 65536
+    INTEGERS, TABLE, STRINGS = 0, 1, 2
+
+    def __init__(self,filename,field_count,source,header):
+        self.filename = filename
+        self.field_count = field_count
+        self._metadata = {'size' : source.st_size, 'mtime' : source.st_mtime, 'header' : header}
+        self._mode = source.st_mode & 0666
+        self._temporary_name = None
+        self._output = None
+        self._cleanup = None
+        self.failed = False
+        self._rows = []
+        self._kinds = array('B')
+        self._error_lines = []
+
+    def add(self,values,kind,error_msg=None):
+        if self.failed:
+            return
+        if values is None:
+            values = ('',) * self.field_count
+            self._error_lines.append(error_msg)
+        self._rows.append(values)
+        self._kinds.append(kind)
+        if len(self._rows) >= self.BLOCK_SIZE:
+            try:
+                self._write_block()
+            except (IOError, OSError) as error:
+                self._fail(error)
+
+    def close(self):
+        if self.failed:
+            return
+        try:
+            if self._output is None:
+                self._open()
+            if self._rows:
+                self._write_block()
+            blocks_end = self._output.tell()
+            metadata = json.dumps(self._metadata)
+            self._output.write(metadata)
+            self._output.write(struct.pack('<QQ4s', blocks_end, len(metadata), self.MAGIC))
+            self._output.close()
+            if os.name == 'nt' and os.path.exists(self.filename):
+                os.remove(self.filename)
+            os.rename(self._temporary_name, self.filename)
+        except (IOError, OSError) as error:
+            self._fail(error)
+            return
+        _pending_cache_files.pop(self._cleanup, None)
+        self._output = None
+
+    def abandon(self):
+        if self._output is not None:
+            _remove_cache_file(_pending_cache_files.pop(self._cleanup, None))
+            self._output = None
+        self._rows = []
+
+    def _fail(self,error):
+        logging.warning("Not caching %s: %s", self.filename, error)
+        self.failed = True
+        self.abandon()
+
+    def _open(self):
+        directory, name = os.path.split(self.filename)
+        handle, self._temporary_name = tempfile.mkstemp(prefix="%s." % name, suffix='.tmp', dir=directory or '.')
+        self._output = os.fdopen(handle,'wb')
+        #mkstemp only lets the owner read the file, make the cache as readable as the log it came from
+        os.chmod(self._temporary_name, self._mode)
+        #A writer that is dropped before close() or abandon() takes its temporary file with it
+        self._cleanup = weakref.ref(self, _abandoned_cache_writer)
+        _pending_cache_files[self._cleanup] = (self._output, self._temporary_name)
+        self._output.write(struct.pack('<4sB', self.MAGIC, self.VERSION))
+
+    def _write_block(self):
+        if self._output is None:
+            self._open()
+        parts = [struct.pack('<I', len(self._rows)), self._kinds.tostring(), _pack_strings(self._error_lines)]
+        for column in zip(*self._rows):
+            parts.append(self._pack_column(column))
+        block = ''.join(parts)
+        self._output.write(struct.pack('<Q', len(block)))
+        self._output.write(block)
+        self._rows = []
+        self._kinds = array('B')
+        self._error_lines = []
+
+    def _pack_column(self,column):
+        rows = len(column)
+        try:
+            integers = [int(value) for value in column]
+        except ValueError:
+            integers = None
+        #Only values that turn back into exactly the same string can be stored as integers
+        if integers is not None and map(str, integers) == list(column) and \
+           max(integers) < 2 ** 63 and min(integers) >= 0:
+            return struct.pack('<B%dq' % rows, self.INTEGERS, *integers)
+        table = {}
+        for value in column:
+            if value not in table:
+                table[value] = len(table)
+                if len(table) > rows // 2:
+                    return struct.pack('<B', self.STRINGS) + _pack_strings(column)
+        values = sorted(table, key=table.get)
+        code_format = 'H' if len(values) <= 0xFFFF else 'I'
+        codes = [table[value] for value in column]
+        return struct.pack('<Bc', self.TABLE, code_format) + _pack_strings(values) + \
+               struct.pack('<%d%s' % (rows, code_format), *codes)
+
+
+#Temporary files of the cache writers still in progress, by a weak reference to their writer
+_pending_cache_files = {}
+
+def _remove_cache_file(pending):
+    if pending is None:
+        return
+    output, name = pending
+    try:
+        output.close()
+        os.remove(name)
+    except (IOError, OSError):
+        pass
+
+def _abandoned_cache_writer(reference):
+    _remove_cache_file(_pending_cache_files.pop(reference, None))
+
+
+class iPlanetLogCacheReader(object):
+    #Reads back what iPlanetLogCacheWriter wrote, a block at a time, as (values, kind, error_msg)
+    EXTENSION = '.ipcache'
+
+    def __init__(self,filename,field_count):
+        self.field_count = field_count
+        self._input = open(filename,'rb')
+        self._blocks_end = self.read_footer(self._input)[0]
+        self._input.seek(5)
+        self._rows = iter(())
+        self.rows_read = 0
+
+    @classmethod
+    def read_footer(cls,cache_input):
+        cache_input.seek(-20, os.SEEK_END)
+        blocks_end, metadata_length, magic = struct.unpack('<QQ4s', cache_input.read(20))
+        if magic != iPlanetLogCacheWriter.MAGIC:
+            raise ValueError("Not an iPlanetLog cache")
+        cache_input.seek(blocks_end)
+        return blocks_end, json.loads(cache_input.read(metadata_length))
+
+    @classmethod
+    def is_valid(cls,filename,source,header):
+        try:
+            cache_input = open(filename,'rb')
+        except IOError:
+            return False
+        try:
+            try:
+                if struct.unpack('<4sB', cache_input.read(5)) != (iPlanetLogCacheWriter.MAGIC,
+                                                                 iPlanetLogCacheWriter.VERSION):
+                    return False
+                metadata = cls.read_footer(cache_input)[1]
+            except (struct.error, ValueError, IOError):
+                return False
+        finally:
+            cache_input.close()
+        return metadata == {'size' : source.st_size, 'mtime' : source.st_mtime, 'header' : header}
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            row = self._rows.next()
+        except StopIteration:
+            if self._input.tell() >= self._blocks_end:
+                self._input.close()
+                raise
+            self._rows = self._read_block()
+            row = self._rows.next()
+        self.rows_read += 1
+        return row
+
+    def close(self):
+        self._input.close()
+
+    def _read_block(self):
+        data = self._input.read(struct.unpack('<Q', self._input.read(8))[0])
+        rows = struct.unpack_from('<I', data)[0]
+        kinds = array('B', data[4:4 + rows])
+        error_lines, offset = _unpack_strings(data, 4 + rows)
+        columns = []
+        for column in xrange(self.field_count):
+            encoding = struct.unpack_from('<B', data, offset)[0]
+            offset += 1
+            if encoding == iPlanetLogCacheWriter.INTEGERS:
+                values = map(str, struct.unpack_from('<%dq' % rows, data, offset))
+                offset += 8 * rows
+            elif encoding == iPlanetLogCacheWriter.TABLE:
+                code_format = data[offset]
+                table, offset = _unpack_strings(data, offset + 1)
+                codes = struct.unpack_from('<%d%s' % (rows, code_format), data, offset)
+                offset += struct.calcsize('<%d%s' % (rows, code_format))
+                values = map(table.__getitem__, codes)
+            else:
+                values, offset = _unpack_strings(data, offset)
+            columns.append(values)
+        error_lines = iter(error_lines)
+        for values, kind in itertools.izip(itertools.izip(*columns), kinds):
+            if kind == PARSE_ERROR:
+                yield None, kind, error_lines.next()
+            else:
+                yield values, kind, None
+
+
+def _pack_strings(strings):
+    return struct.pack('<I%dI' % len(strings), len(strings), *map(len, strings)) + ''.join(strings)
+
+def _unpack_strings(data, offset):
+    count = struct.unpack_from('<I', data, offset)[0]
+    offset += 4
+    lengths = struct.unpack_from('<%dI' % count, data, offset)
+    offset += 4 * count
+    strings = []
+    for length in lengths:
+        strings.append(data[offset:offset + length])
+        offset += length
+    return strings, offset
+
+
+class iPlanetLogFile(object):
+
+    INTERNED_FIELDS = ('user_agent', 'referer', 'content_type', 'status', 'request', 'version')
+
+    def __init__(self,file,use_mmap=False,cache=False,intern_fields=None,intern_capacity=4096,timing=False,
+                 callback=None,callback_interval=10000):
+        self._file = file
+        self._buffer = None
+        self._cache_reader = None
+        self._cache_writer = None
+        line = self._file.readline()
+        if "format=" in line:
+            line = line.replace("format=", "")
+        else:
+            raise TypeError("Log file does not have the proper header")
+        self._format = iPlanetLogFormat.from_header(line)
+        self._fields = self._format.fields
+        self._field_names = self._format.field_names
+        self._layout = self._format.layout
+        self.regex_string = self._format.regex_string
+        self.regex_object = self._format.regex_object
+        self._buffer_regex_object = self._format.buffer_regex_object
+        self._field_patterns = self._format.field_patterns
+        self._continuation_patterns = self._format.continuation_patterns
+        self.first_success = 0
+        self.rehash_success = 0
+        self.stats = iPlanetLogStats()
+        self._interner = None
+        self._record_interner = None
+        self._intern_positions = ()
+        if intern_fields:
+            #intern_fields=True shares the usual low cardinality fields, or pass the attribute names to share
+            if intern_fields is True:
+                intern_fields = self.INTERNED_FIELDS
+            self._interner = iPlanetLogInterner(intern_capacity)
+            self._intern_positions = tuple(self._layout.index[name] for name in intern_fields
+                                           if name in self._layout.index)
+            if 'request' in intern_fields or 'version' in intern_fields:
+                self._record_interner = self._interner
+        try:
+            self._body_start = self._file.tell()
+        except (IOError, AttributeError):
+            self._body_start = None
+        if use_mmap:
+            #Run the compiled expression straight over the mapped file so a line only gets copied into its own
+            #string when it has to go through parse_by_field
+            if not isinstance(self._file, types.FileType):
+                #gzip and bz2 files have a fileno() too, but it maps the compressed bytes
+                raise ValueError("use_mmap needs a plain uncompressed file, not %s" % type(self._file).__name__)
+            self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._position = self._file.tell()
+        if cache:
+            #Read the parsed lines back from a cache next to the log when it is still valid, otherwise write one
+            #as the log is read through to the end
+            cache_name = "%s%s" % (self._file.name, iPlanetLogCacheReader.EXTENSION)
+            source = os.fstat(self._file.fileno())
+            header = "format=%s" % line
+            if iPlanetLogCacheReader.is_valid(cache_name, source, header):
+                self._cache_reader = iPlanetLogCacheReader(cache_name, len(self._fields))
+            else:
+                self._cache_writer = iPlanetLogCacheWriter(cache_name, len(self._fields), source, header)
+        #Timing and the callback swap in instance attributes for the methods they watch, so a file opened without
+        #them runs exactly the same code as before
+        if timing:
+            self._next_match = self._timed_next_match
+            self._repair = self._timed_repair
+            self._make_record = self._timed_make_record
+        self._callback = callback
+        self._callback_interval = callback_interval
+        self._observed = 0
+        self._reported = 0
+        if callback is not None:
+            self._next_parsed = self._observed_next_parsed
+
+    def __iter__(self):
+        return self
+
+    def is_last_field(self,field):
+        return field.name == self._fields[-1].name and not field.isempty()
+
+    @property
+    def fields(self):
+        fields_copy = copy.deepcopy(self._fields)
+        return fields_copy
+
+    def read(self):
+        if self._buffer is not None:
+            start, end = self._next_line_span()
+            return self._buffer[start:end]
+        data = self._file.next()
+        return data
+
+    def next(self):
+        values, kind, error_msg = self._next_parsed()
+        if values is None:
+            return iPlanetLogRecord(errors=error_msg)
+        return self._make_record(values)
+
+    def _make_record(self,values):
+        return iPlanetLogRecord(values=values, layout=self._layout, interner=self._record_interner)
+
+    def statistics(self):
+        #Everything counted so far as a plain dictionary, which is also what the callback is handed
+        statistics = self.stats.as_dict()
+        statistics['format'] = self._format.header.strip()
+        statistics['first_success'] = self.first_success
+        statistics['rehash_success'] = self.rehash_success
+        return statistics
+
+    def _intern_values(self,values):
+        if not self._intern_positions:
+            return values
+        values = list(values)
+        intern = self._interner.intern
+        for position in self._intern_positions:
+            values[position] = intern(values[position])
+        return tuple(values)
+
+    def _next_parsed(self):
+        #Returns (values, kind, error_msg) for the next line, where kind is FIRST_PASS, REHASH or PARSE_ERROR
+        if self._cache_reader is not None:
+            parsed = self._cache_reader.next()
+            if parsed[1] == FIRST_PASS:
+                self.first_success += 1
+            elif parsed[1] == REHASH:
+                self.rehash_success += 1
+            if self._interner is not None and parsed[0] is not None:
+                parsed = (self._intern_values(parsed[0]), parsed[1], parsed[2])
+            return parsed
+        try:
+            line, results = self._next_match()
+        except StopIteration:
+            if self._cache_writer is not None:
+                self._cache_writer.close()
+                self._cache_writer = None
+            raise
+        if results:
+            self.first_success += 1
+            parsed = (self._intern_values(results.groups()), FIRST_PASS, None)
+        else:
+            parsed = self._repair(line)
+        if self._cache_writer is not None:
+            self._cache_writer.add(*parsed)
+        return parsed
+
+    def _observed_next_parsed(self):
+        #Stands in for _next_parsed when there is a callback. It is handed statistics() every callback_interval
+        #lines and once more at the end of the file.
+        try:
+            parsed = iPlanetLogFile._next_parsed(self)
+        except StopIteration:
+            if self._observed != self._reported:
+                self._reported = self._observed
+                self._callback(self.statistics())
+            raise
+        self._observed += 1
+        if self._observed % self._callback_interval == 0:
+            self._reported = self._observed
+            self._callback(self.statistics())
+        return parsed
+
+    def _abandon_cache(self,catch_up=True):
+        #Anything that skips lines would leave holes in a cache being written, and has to read the log itself
+        #rather than a cache being read. With catch_up the log is moved past the lines already read from the cache,
+        #which a caller about to seek somewhere else can skip.
+        if self._cache_writer is not None:
+            self._cache_writer.abandon()
+            self._cache_writer = None
+        if self._cache_reader is not None:
+            rows_read = self._cache_reader.rows_read
+            self._cache_reader.close()
+            self._cache_reader = None
+            if catch_up:
+                try:
+                    for line in xrange(rows_read):
+                        self.read()
+                except StopIteration:
+                    pass
+
+    def _seekable(self):
+        #Compressed files and StringIO can not be searched by byte offset
+        if self._buffer is not None:
+            return True
+        return isinstance(self._file, types.FileType) and self._body_start is not None
+
+    def _next_line_span(self):
+        start = self._position
+        if start >= len(self._buffer):
+            raise StopIteration
+        end = self._buffer.find("\n", start)
+        if end == -1:
+            end = len(self._buffer)
+        else:
+            end += 1
+        self._position = end
+        return start, end
+
+    def _next_match(self):
+        #Returns (line, match). line is only filled in when the first pass regex did not match.
+        if self._buffer is not None:
+            start, end = self._next_line_span()
+            results = self._buffer_regex_object.match(self._buffer, start, end)
+            if results:
+                return None, results
+            return self._buffer[start:end], None
+        line = self.read()
+        return line, self.regex_object.match(line)
+
+    def _timed_next_match(self):
+        timers = self.stats.timers
+        started = timeit.default_timer()
+        if self._buffer is not None:
+            start, end = self._next_line_span()
+            read = timeit.default_timer()
+            results = self._buffer_regex_object.match(self._buffer, start, end)
+            line = None if results else self._buffer[start:end]
+        else:
+            line = self.read()
+            read = timeit.default_timer()
+            results = self.regex_object.match(line)
+        matched = timeit.default_timer()
+        timers['read'] += read - started
+        timers['first_pass'] += matched - read
+        return line, results
+
+    def _timed_repair(self,line):
+        started = timeit.default_timer()
+        parsed = iPlanetLogFile._repair(self, line)
+        self.stats.timers['repair'] += timeit.default_timer() - started
+        return parsed
+
+    def _timed_make_record(self,values):
+        started = timeit.default_timer()
+        record = iPlanetLogFile._make_record(self, values)
+        self.stats.timers['record'] += timeit.default_timer() - started
+        return record
+
+    def _next_values(self):
+        #Same as next() but hands back the raw field values (or None for a line that could not be parsed) without
+        #building a record for lines the first pass regex matches.
+        return self._next_parsed()[0]
+
+    SYSDATE_PATTERN = re.compile(r'\[([0-9]{2}/[A-Za-z]{3}/[0-9]{4}:[0-9]{2}:[0-9]{2}:[0-9]{2} [-+][0-9]{4})\]')
+
+    def filter(self,status=None,url=None,clientip=None,start=None,end=None,slack=60):
+        #Yields only the records that match every condition given. status, url and clientip are prefixes (or tuples
+        #of prefixes), so status="5" is every 5xx response. start and end are epoch seconds or datetimes (naive ones
+        #are taken as UTC) and are inclusive. Conditions are checked on the raw match groups, or on the raw line
+        #before parse_by_field is tried, so lines that do not match never become records. Lines that can not be
+        #parsed are skipped.
+        #Logs are written in time order, so a start time is found by binary search, and reading stops once lines
+        #are more than slack seconds past the end time. Compressed files and StringIO can not be searched, so they
+        #are read on from the current line with the earlier lines skipped by the start condition.
+        start = _to_epoch(start)
+        end = _to_epoch(end)
+        search = start is not None and self._seekable()
+        self._abandon_cache(catch_up=not search)
+        if search:
+            self.seek_time(start - slack)
+        keep = self._build_filter(status, url, clientip, start, end)
+        index = self._layout.index
+        date_time = index.get('_datetime')
+        decode = self._layout.date_decoder.decode
+        stop = end + slack if end is not None else None
+        while True:
+            try:
+                line, results = self._next_match()
+            except StopIteration:
+                return
+            if results:
+                self.first_success += 1
+                values = results.groups()
+                if stop is not None and date_time is not None:
+                    epoch = decode(values[date_time])[2]
+                    if epoch is not None and epoch > stop:
+                        return
+                if keep(values):
+                    yield self._make_record(self._intern_values(values))
+                continue
+            if start is not None or end is not None:
+                raw_date = self.SYSDATE_PATTERN.search(line)
+                epoch = decode(raw_date.group(1))[2] if raw_date else None
+                if epoch is not None:
+                    if stop is not None and epoch > stop:
+                        return
+                    if (start is not None and epoch < start) or (end is not None and epoch > end):
+                        continue
+            if clientip is not None and index.get('clientip') == 0 and not line.startswith(clientip):
+                continue
+            record = self.parse_by_field(line)
+            if not record.has_errors and keep(record._values):
+                yield record
+
+    def _build_filter(self,status,url,clientip,start,end):
+        index = self._layout.index
+        checks = []
+        def position(name):
+            try:
+                return index[name]
+            except KeyError:
+                raise ValueError("Log format has no field to filter on for %s" % name)
+        if status is not None:
+            status_position = position('status')
+            checks.append(lambda values: values[status_position].startswith(status))
+        if clientip is not None:
+            clientip_position = position('clientip')
+            checks.append(lambda values: values[clientip_position].startswith(clientip))
+        if start is not None or end is not None:
+            date_position = position('_datetime')
+            decode = self._layout.date_decoder.decode
+            lowest = start if start is not None else float('-inf')
+            highest = end if end is not None else float('inf')
+            def in_range(values):
+                epoch = decode(values[date_position])[2]
+                return epoch is not None and lowest <= epoch <= highest
+            checks.append(in_range)
+        if url is not None:
+            request_position = position('_request_string')
+            url_pattern = iPlanetLogRecord.REQUEST_PATTERNS['url']
+            def url_matches(values):
+                results = url_pattern.match(values[request_position])
+                return results is not None and results.group(1).startswith(url)
+            checks.append(url_matches)
+        def keep(values):
+            for check in checks:
+                if not check(values):
+                    return False
+            return True
+        return keep
+
+    def seek_time(self,epoch):
+        #Moves the reader to the first line logged at or after epoch with a binary search over the file's byte
+        #offsets. Only works on plain (seekable, uncompressed) files.
+        if not self._seekable():
+            raise IOError("Can only seek in a plain uncompressed log file, not %s" % self._file.__class__.__name__)
+        self._abandon_cache(catch_up=False)
+        if self._buffer is not None:
+            size = len(self._buffer)
+        else:
+            size = os.fstat(self._file.fileno()).st_size
+        low, high = self._body_start, size
+        while low < high:
+            middle = (low + high) // 2
+            line_end, line_epoch = self._time_at(middle, size)
+            if line_epoch is None or line_epoch >= epoch:
+                high = middle
+            else:
+                low = line_end
+        line_start = self._line_at(low)[0]
+        if self._buffer is not None:
+            self._position = line_start
+        else:
+            self._file.seek(line_start)
+
+    def _time_at(self,position,size):
+        #Returns (end offset, epoch) of the first line at or after position that has a readable timestamp
+        decode = self._layout.date_decoder.decode
+        while position < size:
+            line_start, line = self._line_at(position)
+            if not line:
+                break
+            position = line_start + len(line)
+            raw_date = self.SYSDATE_PATTERN.search(line)
+            if raw_date:
+                epoch = decode(raw_date.group(1))[2]
+                if epoch is not None:
+                    return position, epoch
+        return size, None
+
+    def _line_at(self,position):
+        #Returns (offset, line) for the first line that starts at or after position
+        if self._buffer is not None:
+            if position > self._body_start and self._buffer[position - 1] != "\n":
+                position = self._buffer.find("\n", position)
+                if position == -1:
+                    return len(self._buffer), ""
+                position += 1
+            end = self._buffer.find("\n", position)
+            end = len(self._buffer) if end == -1 else end + 1
+            return position, self._buffer[position:end]
+        if position > self._body_start:
+            self._file.seek(position - 1)
+            self._file.readline()
+        else:
+            self._file.seek(position)
+        position = self._file.tell()
+        return position, self._file.readline()
+
+    BATCH_COLUMNS = ('clientip', 'epoch', 'status', 'content_length', 'url', 'user_agent', 'referer')
+
+    def read_batch(self,size,columns=None):
+        #Without columns, every one of BATCH_COLUMNS the format has is read
+        columns = columns or tuple(name for name in self.BATCH_COLUMNS
+                                   if self._column_source(name) in self._layout.index)
+        extractors = [self._column_extractor(name) for name in columns]
+        missing = [-1 if name in iPlanetLogBatch.INTEGER_COLUMNS else "-" for name in columns]
+        data = [[] for name in columns]
+        errors = []
+        while len(errors) < size:
+            try:
+                values = self._next_values()
+            except StopIteration:
+                break
+            if values is None:
+                errors.append(True)
+                for column, value in zip(data, missing):
+                    column.append(value)
+            else:
+                errors.append(False)
+                for column, extractor in zip(data, extractors):
+                    column.append(extractor(values))
+        return iPlanetLogBatch(columns, data, errors)
+
+    def batches(self,size,columns=None):
+        while True:
+            batch = self.read_batch(size, columns)
+            if not len(batch):
+                return
+            yield batch
+
+    def _column_source(self,name):
+        #The match group a batch column is read from
+        if name == 'epoch':
+            return '_datetime'
+        if name in iPlanetLogRecord.REQUEST_PATTERNS:
+            return '_request_string'
+        return name
+
+    def _column_extractor(self,name):
+        index = self._layout.index
+        if self._column_source(name) not in index:
+            raise ValueError("Unknown batch column: %s" % name)
+        if name == 'epoch':
+            position = index['_datetime']
+            decode = self._layout.date_decoder.decode
+            def extract(values):
+                epoch = decode(values[position])[2]
+                if epoch is None:
+                    return -1
+                return epoch
+        elif name in iPlanetLogRecord.REQUEST_PATTERNS:
+            position = index['_request_string']
+            pattern = iPlanetLogRecord.REQUEST_PATTERNS[name]
+            def extract(values):
+                results = pattern.match(values[position])
+                return results.group(1) if results else "-"
+        else:
+            position = index[name]
+            if name in iPlanetLogBatch.INTEGER_COLUMNS:
+                def extract(values):
+                    try:
+                        return int(values[position])
+                    except ValueError:
+                        return -1
+            else:
+                def extract(values):
+                    return values[position]
+        return extract
+
+    def parse_line(self,line):
+        try:
+            return self._parse_log_line(line)
+        except FieldDelimiterError:
+            return self.parse_by_field(line)
+
+    def _parse_log_line(self,line):
+        results = self.regex_object.match(line)
+        if results:
+            self.first_success += 1
+            return self._make_record(self._intern_values(results.groups()))
+        else:
+            raise FieldDelimiterError('Could not parse with single regex')
+
+    def parse_by_field(self,line):
+        values, kind, error_msg = self._repair(line)
+        if values is None:
+            return iPlanetLogRecord(errors=error_msg)
+        return self._make_record(values)
+
+    def _repair(self,line):
+        #This will go field by field in an attempt to parse the log. Sometimes we find the log entry does not match the
+        #field delimiter specified. (Like url strings not being encoded prior to being sent to the log, so occasionally
+        #an actual space character will show up, breaking the specified field format)
+        #When a field will not match where it should start, the previous field is assumed to contain its own delimiter
+        #and is grown through its next delimiter until the current field matches. Positions only ever move forward.
+        #Returns (values, kind, error_msg) the same way _next_parsed does.
+        values = []
+        value_ends = []
+        position = 0
+        depth = 0
+        for index, field in enumerate(self._fields):
+            results = self._field_patterns[index].match(line, position)
+            while results is None and not field.isempty() and not self.is_last_field(field):
+                if not values or self._fields[index - 1].isempty():
+                    return self._parse_error(line, field)
+                previous_field = self._fields[index - 1]
+                dangling = self._continuation_patterns[index - 1].match(line, value_ends[-1] + 1)
+                if dangling is None:
+                    return self._parse_error(line, field)
+                values[-1] = "%s%s%s" % (values[-1], previous_field.end_delimiter, dangling.group(1))
+                value_ends[-1] = dangling.end(1)
+                position = dangling.end()
+                depth += 1
+                results = self._field_patterns[index].match(line, position)
+            if results:
+                values.append(results.group(1))
+                value_ends.append(results.end(1))
+                position = results.end()
+            elif field.isempty():
+                values.append('')
+                value_ends.append(position)
+            else:
+                values.append(line[position:].rstrip())
+                value_ends.append(len(line))
+                position = len(line)
+        self.rehash_success += 1
+        self.stats.add_repair(depth)
+        return self._intern_values(values), REHASH, None
+
+    def _parse_error(self,line,field):
+        self.stats.add_error(self._field_names.get(field.name, field.name), line)
+        return None, PARSE_ERROR, line
+
+    def field_to_attribute(self,field_name):
+        return self._field_names[field_name]
+
+
+def _to_epoch(value):
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            return calendar.timegm(value.utctimetuple())
+        return calendar.timegm(value.timetuple())
+    return value
+
+#Each pool process opens the log once and keeps its own parser around for every range it is handed.
+_range_parser = None
+
+def _parallel_worker_init(filename):
+    global _range_parser
+    _range_parser = iPlanetLogFile(open(filename,'rb'))
+
+def _parallel_parse_range(task):
+    start, end, ordered_output, delimiter, replace_spaces = task
+    parser = _range_parser
+    parser.first_success = 0
+    parser.rehash_success = 0
+    log_file = parser._file
+    log_file.seek(start)
+    position = start
+    results = []
+    while position < end:
+        line = log_file.readline()
+        if not line:
+            break
+        position += len(line)
+        record = parser.parse_line(line)
+        if record.has_errors:
+            results.append((None, record.error_msg))
+        elif ordered_output:
+            results.append((record.as_string(delimiter=delimiter,replace_spaces=replace_spaces,
+                                             ordered_output=ordered_output), None))
         else:
-            print "Error loading\n %s" % entry.error_msg
-            error_count += 1
-    if write_buffer:
-        output_file.writelines(write_buffer)
-    print "Number of Errors %s" % error_count
-    print "First pass success: %s" % parser.first_success
-    print "Rehash success: %s" % parser.rehash_success
+            results.append((record._values, None))
+    return results, parser.first_success, parser.rehash_success, parser.stats.drain()
+
+
+class iPlanetLogParallelFile(object):
+    #Splits the body of a log into newline aligned byte ranges and parses them in a process pool. Results come back
+    #in the same order as the file, and the success counters and stats are added up across the workers.
+
+    def __init__(self,filename,processes=None,range_size=16 * 1024 * 1024):
+        self.filename = filename
+        self.processes = processes or multiprocessing.cpu_count()
+        self.range_size = range_size
+        log_file = open(filename,'rb')
+        self._parser = iPlanetLogFile(log_file)
+        self._ranges = self._split_ranges(log_file)
+        log_file.close()
+        self.first_success = 0
+        self.rehash_success = 0
+        self.error_count = 0
+        self.stats = iPlanetLogStats()
+
+    def __iter__(self):
+        for values, error_msg in self._run(None, " ", False):
+            if values is None:
+                yield iPlanetLogRecord(errors=error_msg)
+            else:
+                yield iPlanetLogRecord(values=values, layout=self._parser._layout)
+
+    def as_strings(self,delimiter=" ",replace_spaces=False, ordered_output=None):
+        #Yields (has_errors, value) pairs where value is either the converted line or the offending log line
+        ordered_output = ordered_output or self._parser._layout.public_names + \
+                         list(iPlanetLogRecord.COMBINED_FIELDS)
+        for output, error_msg in self._run(tuple(ordered_output), delimiter, replace_spaces):
+            if output is None:
+                yield True, error_msg
+            else:
+                yield False, output
+
+    def _split_ranges(self,log_file):
+        start = log_file.tell()
+        log_file.seek(0, os.SEEK_END)
+        size = log_file.tell()
+        ranges = []
+        while start < size:
+            log_file.seek(min(start + self.range_size, size))
+            log_file.readline()
+            end = min(log_file.tell(), size)
+            ranges.append((start, end))
+            start = end
+        return ranges
+
+    def _run(self,ordered_output,delimiter,replace_spaces):
+        self.first_success = 0
+        self.rehash_success = 0
+        self.error_count = 0
+        self.stats = iPlanetLogStats()
+        tasks = ((start, end, ordered_output, delimiter, replace_spaces) for start, end in self._ranges)
+        pool = multiprocessing.Pool(self.processes, _parallel_worker_init, (self.filename,))
+        try:
+            #At most two ranges per process are handed out at a time, so a slow consumer holds back the workers
+            #instead of finished ranges piling up here
+            pending = collections.deque(pool.apply_async(_parallel_parse_range, (task,))
+                                        for task in itertools.islice(tasks, self.processes * 2))
+            while pending:
+                results, first_success, rehash_success, stats = pending.popleft().get()
+                for task in itertools.islice(tasks, 1):
+                    pending.append(pool.apply_async(_parallel_parse_range, (task,)))
+                self.first_success += first_success
+                self.rehash_success += rehash_success
+                self.stats.merge(stats)
+                for entry in results:
+                    if entry[0] is None:
+                        self.error_count += 1
+                    yield entry
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+class iPlanetLogFollower(object):
+    #Follows the access.YYYYMMDDhhmm logs in a directory as they are written, moving on to the next file once the
+    #server rotates. Partial lines at the end of the live file are held back until the rest of the line arrives.
+    #When a checkpoint file is given, the current file's identity, the offset just past the last record handed out
+    #and the format header are saved there, and a new follower resumes from that point.
+
+    def __init__(self,directory,checkpoint_file=None,prefix="access.",poll_interval=1.0,checkpoint_interval=1000):
+        self.directory = directory
+        self.checkpoint_file = checkpoint_file
+        self.prefix = prefix
+        self.poll_interval = poll_interval
+        self.checkpoint_interval = checkpoint_interval
+        self._file = None
+        self._parser = None
+        self._name = None
+        self._identity = None
+        self._header = None
+        self._offset = 0
+        self._first_success = 0
+        self._rehash_success = 0
+        self._resume = self._load_checkpoint()
+
+    @property
+    def first_success(self):
+        return self._first_success + (self._parser.first_success if self._parser else 0)
+
+    @property
+    def rehash_success(self):
+        return self._rehash_success + (self._parser.rehash_success if self._parser else 0)
+
+    def follow(self,idle_timeout=None):
+        #Yields records forever, or until nothing new has shown up for idle_timeout seconds
+        idle = 0
+        unsaved = 0
+        try:
+            while True:
+                if self._file is None and not self._open_next():
+                    if idle_timeout is not None and idle >= idle_timeout:
+                        return
+                    time.sleep(self.poll_interval)
+                    idle += self.poll_interval
+                    continue
+                line = self._file.readline()
+                if line.endswith("\n"):
+                    self._offset += len(line)
+                    idle = 0
+                    yield self._parser.parse_line(line)
+                    unsaved += 1
+                    if unsaved >= self.checkpoint_interval:
+                        self.save_checkpoint()
+                        unsaved = 0
+                    continue
+                self._file.seek(self._offset)
+                if self._next_name() is not None:
+                    #The server has moved on to a new file, so whatever is left of this one is complete
+                    for line in self._file.read().splitlines(True):
+                        self._offset += len(line)
+                        yield self._parser.parse_line(line)
+                    self._close()
+                    self.save_checkpoint()
+                    unsaved = 0
+                    continue
+                if self._replaced():
+                    self._resume = {'name' : self._name, 'identity' : None, 'header' : None, 'offset' : 0}
+                    self._close()
+                    continue
+                if unsaved:
+                    self.save_checkpoint()
+                    unsaved = 0
+                if idle_timeout is not None and idle >= idle_timeout:
+                    return
+                time.sleep(self.poll_interval)
+                idle += self.poll_interval
+        finally:
+            self.save_checkpoint()
+
+    def save_checkpoint(self):
+        if not self.checkpoint_file or self._name is None:
+            return
+        checkpoint = {'name' : self._name, 'identity' : self._identity, 'offset' : self._offset,
+                      'header' : self._header}
+        temporary_file = "%s.tmp" % self.checkpoint_file
+        output = open(temporary_file,'w')
+        json.dump(checkpoint, output)
+        output.flush()
+        os.fsync(output.fileno())
+        output.close()
+        if os.name == 'nt' and os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+        os.rename(temporary_file, self.checkpoint_file)
+
+    def _load_checkpoint(self):
+        if not self.checkpoint_file or not os.path.exists(self.checkpoint_file):
+            return None
+        checkpoint_input = open(self.checkpoint_file)
+        try:
+            checkpoint = json.load(checkpoint_input)
+        finally:
+            checkpoint_input.close()
+        #Lets _next_name() pick up from the checkpointed file even if it has been rotated away
+        self._name = checkpoint['name']
+        return checkpoint
+
+    def _log_names(self):
+        #Only prefix plus the timestamp, so caches, temporary files and checkpoints next to the logs are left alone
+        pattern = re.compile(r'%s[0-9]{12}$' % re.escape(self.prefix))
+        return sorted(name for name in os.listdir(self.directory) if pattern.match(name))
+
+    def _next_name(self):
+        for name in self._log_names():
+            if self._name is None or name > self._name:
+                return name
+        return None
+
+    def _open_next(self):
+        checkpoint, self._resume = self._resume, None
+        if checkpoint and checkpoint['name'] in self._log_names():
+            if self._open(checkpoint['name']):
+                if [self._identity, self._header] == [checkpoint['identity'], checkpoint['header']] and \
+                   checkpoint['offset'] <= os.fstat(self._file.fileno()).st_size:
+                    self._offset = checkpoint['offset']
+                    self._file.seek(self._offset)
+                return True
+            self._resume = checkpoint
+            return False
+        if self._name is None:
+            names = self._log_names()
+            name = names[-1] if names else None
+        else:
+            name = self._next_name()
+        return name is not None and self._open(name)
+
+    def _open(self,name):
+        log_file = open(os.path.join(self.directory, name),'rb')
+        header = log_file.readline()
+        if not header.endswith("\n"):
+            #The server has not finished writing the header yet
+            log_file.close()
+            return False
+        log_file.seek(0)
+        self._file = log_file
+        self._parser = iPlanetLogFile(log_file)
+        self._name = name
+        self._identity = self._file_identity(os.fstat(log_file.fileno()))
+        self._header = header
+        self._offset = len(header)
+        return True
+
+    def _close(self):
+        self._first_success += self._parser.first_success
+        self._rehash_success += self._parser.rehash_success
+        self._parser = None
+        self._file.close()
+        self._file = None
+
+    def _replaced(self):
+        #A file truncated in place, or a new file moved in under the same name, is read again from the top
+        try:
+            current = os.stat(os.path.join(self.directory, self._name))
+        except OSError:
+            return False
+        return self._file_identity(current) != self._identity or current.st_size < self._offset
+
+    def _file_identity(self,stat):
+        return [stat.st_dev, stat.st_ino]
+
+
+class _MergeSource(object):
+
+    def __init__(self,tag,filename,options):
+        self.tag = tag
+        self.filename = filename
+        self.options = options
+        self.log = None
+        self._file = None
+
+    def read_block(self,size):
+        if self.log is None:
+            self._file = open_log(self.filename)
+            try:
+                self.log = iPlanetLogFile(self._file, **self.options)
+            except Exception:
+                self._file.close()
+                raise
+        block = list(itertools.islice(self.log, size))
+        if not block:
+            self._file.close()
+        return block
+
+
+class iPlanetLogMerger(object):
+    #Reads many logs at once (say one per virtual server, each with its own format= header) and yields
+    #(source, record) pairs merged into a single stream ordered by time. Files are opened and read on a thread pool,
+    #each source keeping at most the block it is being merged from plus one block read ahead, so memory stays
+    #predictable with hundreds of inputs. sources is a list of file names, or a dict of source tag to file name.
+    #Lines that could not be parsed keep their place in their own source's order. Any other keyword arguments go to
+    #iPlanetLogFile.
+
+    def __init__(self,sources,block_size=500,threads=8,**options):
+        if isinstance(sources, dict):
+            sources = sorted(sources.iteritems())
+        else:
+            sources = [(filename, filename) for filename in sources]
+        self._sources = [_MergeSource(tag, filename, options) for tag, filename in sources]
+        self.block_size = block_size
+        self.threads = threads
+
+    @property
+    def first_success(self):
+        return sum(source.log.first_success for source in self._sources if source.log)
+
+    @property
+    def rehash_success(self):
+        return sum(source.log.rehash_success for source in self._sources if source.log)
+
+    def __iter__(self):
+        pool = ThreadPool(self.threads)
+        try:
+            reads = [pool.apply_async(source.read_block, (self.block_size,)) for source in self._sources]
+            blocks = [iter(()) for source in self._sources]
+            last_epoch = [float('-inf')] * len(self._sources)
+            heap = []
+            sequence = itertools.count()
+
+            def push(index):
+                while True:
+                    try:
+                        record = blocks[index].next()
+                        break
+                    except StopIteration:
+                        block = reads[index].get()
+                        if not block:
+                            return
+                        blocks[index] = iter(block)
+                        reads[index] = pool.apply_async(self._sources[index].read_block, (self.block_size,))
+                if not record.has_errors and record.epoch is not None:
+                    last_epoch[index] = record.epoch
+                heapq.heappush(heap, (last_epoch[index], index, sequence.next(), record))
+
+            for index in xrange(len(self._sources)):
+                push(index)
+            while heap:
+                epoch, index, position, record = heapq.heappop(heap)
+                yield self._sources[index].tag, record
+                push(index)
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+def _hash_key(key):
+    #Two independent 64 bit hashes. md5 keeps them stable between processes and machines so sketches built
+    #elsewhere can be merged.
+    return struct.unpack('<QQ', hashlib.md5(key).digest())
+
+
+class iPlanetLogCountMinSketch(object):
+    #Approximate counts for an unbounded set of keys in a fixed width x depth table. Estimates never undercount.
+
+    def __init__(self,width=16384,depth=4):
+        self.width = width
+        self.depth = depth
+        self._rows = [array('d', [0]) * width for row in range(depth)]
+
+    def add(self,key,count=1):
+        return self.add_hashed(_hash_key(key), count)
+
+    def add_hashed(self,hashes,count=1):
+        #Returns the new estimate for the key
+        position, step = hashes
+        estimate = None
+        for row in self._rows:
+            column = position % self.width
+            row[column] += count
+            if estimate is None or row[column] < estimate:
+                estimate = row[column]
+            position += step
+        return int(estimate)
+
+    def estimate(self,key):
+        position, step = _hash_key(key)
+        estimate = None
+        for row in self._rows:
+            value = row[position % self.width]
+            if estimate is None or value < estimate:
+                estimate = value
+            position += step
+        return int(estimate)
+
+    def merge(self,other):
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError("Can only merge sketches of the same width and depth")
+        for row, other_row in zip(self._rows, other._rows):
+            for column in xrange(self.width):
+                row[column] += other_row[column]
+        return self
+
+
+class iPlanetLogTopN(object):
+    #Heavy hitters: a count-min sketch does the counting and only the capacity keys with the highest estimates are
+    #kept around by name.
+
+    def __init__(self,capacity=100,width=16384,depth=4):
+        self.capacity = capacity
+        self.sketch = iPlanetLogCountMinSketch(width, depth)
+        self._candidates = {}
+        self._floor = 0
+
+    def add(self,key,count=1):
+        self.add_hashed(key, _hash_key(key), count)
+
+    def add_hashed(self,key,hashes,count=1):
+        estimate = self.sketch.add_hashed(hashes, count)
+        candidates = self._candidates
+        if key in candidates or len(candidates) < self.capacity:
+            candidates[key] = estimate
+        elif estimate > self._floor:
+            smallest = min(candidates, key=candidates.get)
+            if estimate > candidates[smallest]:
+                del candidates[smallest]
+                candidates[key] = estimate
+                self._floor = min(candidates.itervalues())
+            else:
+                self._floor = candidates[smallest]
+
+    def top(self,n=None):
+        ranked = sorted(self._candidates.iteritems(), key=lambda item: item[1], reverse=True)
+        return ranked[:n] if n else ranked
+
+    def merge(self,other):
+        self.sketch.merge(other.sketch)
+        keys = set(self._candidates).union(other._candidates)
+        ranked = sorted(((key, self.sketch.estimate(key)) for key in keys), key=lambda item: item[1], reverse=True)
+        self._candidates = dict(ranked[:self.capacity])
+        self._floor = min(self._candidates.itervalues()) if self._candidates else 0
+        return self
+
+
+class iPlanetLogHyperLogLog(object):
+    #Distinct count estimate in 2 ** precision one byte registers, about 1.04 / sqrt(2 ** precision) relative error.
+
+    def __init__(self,precision=12):
+        self.precision = precision
+        self._registers = bytearray(1 << precision)
+
+    def add(self,key):
+        self.add_hashed(_hash_key(key))
+
+    def add_hashed(self,hashes):
+        value = hashes[0]
+        register = value >> (64 - self.precision)
+        remainder = value & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - remainder.bit_length() + 1
+        if rank > self._registers[register]:
+            self._registers[register] = rank
+
+    def estimate(self):
+        registers = len(self._registers)
+        alpha = 0.7213 / (1 + 1.079 / registers)
+        estimate = alpha * registers * registers / sum(2.0 ** -rank for rank in self._registers)
+        empty = self._registers.count('\x00')
+        if estimate <= 2.5 * registers and empty:
+            estimate = registers * math.log(float(registers) / empty)
+        return int(round(estimate))
+
+    def merge(self,other):
+        if self.precision != other.precision:
+            raise ValueError("Can only merge HyperLogLogs of the same precision")
+        for register, rank in enumerate(other._registers):
+            if rank > self._registers[register]:
+                self._registers[register] = rank
+        return self
+
+
+class iPlanetLogAggregator(object):
+    #Streaming totals over parsed log lines. Hits, bytes and hits per status are counted exactly. Top URLs,
+    #referers, user agents and clients by bytes sent are tracked with iPlanetLogTopN, and unique visitors (client IPs)
+    #overall and per hour with iPlanetLogHyperLogLog, so memory stays flat however many lines go through.
+    #Aggregators built from separate files or processes can be combined with merge().
+
+    def __init__(self,top_capacity=100,width=16384,depth=4,precision=12):
+        self.precision = precision
+        self.hits = 0
+        self.bytes = 0
+        self.errors = 0
+        self.status_counts = {}
+        self.urls = iPlanetLogTopN(top_capacity, width, depth)
+        self.referers = iPlanetLogTopN(top_capacity, width, depth)
+        self.user_agents = iPlanetLogTopN(top_capacity, width, depth)
+        self.client_bytes = iPlanetLogTopN(top_capacity, width, depth)
+        self.visitors = iPlanetLogHyperLogLog(precision)
+        self.hourly_visitors = {}
+
+    def update(self,log):
+        #Consumes an iPlanetLogFile straight from its field values, without building records
+        index = log._layout.index
+        url_pattern = iPlanetLogRecord.REQUEST_PATTERNS['url']
+        decode = log._layout.date_decoder.decode
+        positions = [index.get(name) for name in ('status', 'content_length', 'clientip', '_request_string',
+                                                  'referer', 'user_agent', '_datetime')]
+        status, content_length, clientip, request_string, referer, user_agent, date_time = positions
+        while True:
+            try:
+                values = log._next_values()
+            except StopIteration:
+                return self
+            if values is None:
+                self.errors += 1
+                continue
+            url = None
+            if request_string is not None:
+                results = url_pattern.match(values[request_string])
+                url = results.group(1) if results else "-"
+            self._add(values[status] if status is not None else None,
+                      values[content_length] if content_length is not None else None,
+                      values[clientip] if clientip is not None else None,
+                      url,
+                      values[referer] if referer is not None else None,
+                      values[user_agent] if user_agent is not None else None,
+                      decode(values[date_time])[2] if date_time is not None else None)
+
+    def add_record(self,record):
+        if record.has_errors:
+            self.errors += 1
+            return
+        self._add(getattr(record, 'status', None), getattr(record, 'content_length', None),
+                  getattr(record, 'clientip', None), getattr(record, 'url', None), getattr(record, 'referer', None),
+                  getattr(record, 'user_agent', None), record.epoch)
+
+    def _add(self,status,content_length,clientip,url,referer,user_agent,epoch):
+        self.hits += 1
+        try:
+            sent = int(content_length)
+        except (TypeError, ValueError):
+            sent = 0
+        self.bytes += sent
+        if status is not None:
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+        if url is not None:
+            self.urls.add(url)
+        if referer is not None:
+            self.referers.add(referer)
+        if user_agent is not None:
+            self.user_agents.add(user_agent)
+        if clientip is not None:
+            hashes = _hash_key(clientip)
+            self.client_bytes.add_hashed(clientip, hashes, sent)
+            self.visitors.add_hashed(hashes)
+            if epoch is not None:
+                hour = epoch - epoch % 3600
+                try:
+                    visitors = self.hourly_visitors[hour]
+                except KeyError:
+                    visitors = self.hourly_visitors[hour] = iPlanetLogHyperLogLog(self.precision)
+                visitors.add_hashed(hashes)
+
+    def unique_visitors(self):
+        return self.visitors.estimate()
+
+    def unique_visitors_per_hour(self):
+        #Keyed on the epoch second the hour starts at
+        return dict((hour, visitors.estimate()) for hour, visitors in self.hourly_visitors.iteritems())
+
+    def merge(self,other):
+        self.hits += other.hits
+        self.bytes += other.bytes
+        self.errors += other.errors
+        for status, count in other.status_counts.iteritems():
+            self.status_counts[status] = self.status_counts.get(status, 0) + count
+        self.urls.merge(other.urls)
+        self.referers.merge(other.referers)
+        self.user_agents.merge(other.user_agents)
+        self.client_bytes.merge(other.client_bytes)
+        self.visitors.merge(other.visitors)
+        for hour, visitors in other.hourly_visitors.iteritems():
+            if hour in self.hourly_visitors:
+                self.hourly_visitors[hour].merge(visitors)
+            else:
+                self.hourly_visitors[hour] = copy.deepcopy(visitors)
+        return self
+
+
+def open_log(filename,mode='r'):
+    #Compressed input is recognised by its magic number, compressed output by the file extension
+    if mode.startswith('r'):
+        raw = open(filename,'rb')
+        magic = raw.read(3)
+        raw.close()
+        if magic.startswith('\x1f\x8b'):
+            return gzip.open(filename,'rb')
+        if magic == 'BZh':
+            return bz2.BZ2File(filename,'rb')
+    elif filename.endswith('.gz'):
+        return gzip.open(filename,'wb')
+    elif filename.endswith('.bz2'):
+        return bz2.BZ2File(filename,'wb')
+    return open(filename,mode)
+
+
+class iPlanetLogConverter(object):
+    #Converts an iPlanet access log to the IIS W3C format. Reading (and decompressing) the input, parsing, and
+    #formatting/writing the output each run on their own thread, handing blocks of lines to each other through
+    #bounded queues so the file I/O overlaps with the parsing.
+    OUTPUT_ORDER = ('clientip','user','date','request','status','user_agent','time','url',
+                    'query_string','cookies', 'referer')
+    W3C_FIELD_NAMES = {'clientip' : 'c-ip', 'user' : 'cs-username', 'date' : 'date', 'time' : 'time',
+                       'request' : 'cs-method', 'url' : 'cs-uri-stem', 'query_string' : 'cs-uri-query',
+                       'version' : 'cs-version', 'status' : 'sc-status', 'content_length' : 'sc-bytes',
+                       'user_agent' : 'cs(User-Agent)', 'cookies' : 'cs(Cookie)', 'referer' : 'cs(Referer)',
+                       'content_type' : 'sc(Content-Type)'}
+
+    def __init__(self,input_name,output_name,ordered_output=None,delimiter=" ",replace_spaces=True,
+                 compress_output=False,block_size=1000,queue_size=16):
+        self.input_name = input_name
+        self.output_name = output_name
+        self.ordered_output = tuple(ordered_output or self.OUTPUT_ORDER)
+        self.delimiter = delimiter
+        self.replace_spaces = replace_spaces
+        self.compress_output = compress_output
+        self.block_size = block_size
+        self.queue_size = queue_size
+        self.first_success = 0
+        self.rehash_success = 0
+        self.error_count = 0
+        self.lines_written = 0
+        self.stats = None
+        self.available_fields = None
+        self._failures = []
+
+    def run(self):
+        input_file = open_log(self.input_name)
+        parser = iPlanetLogFile(input_file)
+        self.available_fields = sorted(set(parser._layout.public_names).union(iPlanetLogRecord.COMBINED_FIELDS))
+        for name in self.ordered_output:
+            if name not in self.available_fields:
+                input_file.close()
+                raise ValueError("Unknown output field: %s" % name)
+        if self.compress_output and not self.output_name.endswith('.gz'):
+            output_file = gzip.open(self.output_name,'wb')
+        else:
+            output_file = open_log(self.output_name,'w')
+        lines = Queue.Queue(self.queue_size)
+        records = Queue.Queue(self.queue_size)
+        reader = threading.Thread(target=self._read, args=(input_file, lines))
+        writer = threading.Thread(target=self._write, args=(records, output_file))
+        reader.daemon = writer.daemon = True
+        reader.start()
+        writer.start()
+        try:
+            self._parse(parser, lines, records)
+        finally:
+            writer.join()
+            reader.join()
+            input_file.close()
+            output_file.close()
+        self.first_success = parser.first_success
+        self.rehash_success = parser.rehash_success
+        self.stats = parser.stats
+        if self._failures:
+            raise self._failures[0][0], self._failures[0][1], self._failures[0][2]
+        return self
+
+    def _read(self,input_file,lines):
+        try:
+            while True:
+                block = list(itertools.islice(input_file, self.block_size))
+                if not block or self._failures:
+                    break
+                lines.put(block)
+        except Exception:
+            self._failures.append(sys.exc_info())
+        finally:
+            lines.put(None)
+
+    def _parse(self,parser,lines,records):
+        try:
+            while True:
+                block = lines.get()
+                if block is None:
+                    break
+                if not self._failures:
+                    records.put([parser.parse_line(line) for line in block])
+        except BaseException:
+            #Ctrl-C lands here too. Recording it stops the reader after its current block.
+            self._failures.append(sys.exc_info())
+            #Keep draining so the reader is never left blocked on a full queue
+            while lines.get() is not None:
+                pass
+        finally:
+            records.put(None)
+
+    def _write(self,records,output_file):
+        try:
+            output_file.write("#Software: Microsoft Internet Information Services 6.0\n")
+            output_file.write("#Version: 1.0\n")
+            output_file.write("#Fields: %s\n" % ' '.join(self.W3C_FIELD_NAMES.get(name, name)
+                                                         for name in self.ordered_output))
+            while True:
+                block = records.get()
+                if block is None:
+                    break
+                if self._failures:
+                    continue
+                write_buffer = []
+                for entry in block:
+                    if not entry.has_errors:
+                        write_buffer.append("%s\n" % entry.as_string(delimiter=self.delimiter,
+                                                                     replace_spaces=self.replace_spaces,
+                                                                     ordered_output=self.ordered_output))
+                    else:
+                        sys.stderr.write("Error loading\n %s\n" % entry.error_msg)
+                        self.error_count += 1
+                output_file.writelines(write_buffer)
+                self.lines_written += len(write_buffer)
+        except Exception:
+            self._failures.append(sys.exc_info())
+            while records.get() is not None:
+                pass
+
+
+def main(argv=None):
+    start = time.time()
+    parser = argparse.ArgumentParser(description="Convert an iPlanet access log to the IIS W3C log format. "
+                                                 "gzip and bzip2 compressed input is read transparently.")
+    parser.add_argument('input', help="iPlanet access log, e.g. access.201111170000")
+    parser.add_argument('output', help="converted log, gzip compressed when it ends in .gz")
+    parser.add_argument('-f', '--fields', default=','.join(iPlanetLogConverter.OUTPUT_ORDER),
+                        help="comma separated output field order (default: %(default)s)")
+    parser.add_argument('-d', '--delimiter', default=" ", help="output field delimiter (default: a space)")
+    parser.add_argument('-z', '--gzip', action='store_true', help="gzip compress the output")
+    parser.add_argument('--keep-spaces', action='store_true',
+                        help="do not replace spaces inside values with '+'")
+    parser.add_argument('--block-size', type=int, default=1000, help="lines handed between stages at a time")
+    parser.add_argument('--queue-size', type=int, default=16, help="blocks buffered between stages")
+    args = parser.parse_args(argv)
+
+    converter = iPlanetLogConverter(args.input, args.output,
+                                    ordered_output=[name.strip() for name in args.fields.split(',')],
+                                    delimiter=args.delimiter, replace_spaces=not args.keep_spaces,
+                                    compress_output=args.gzip, block_size=args.block_size,
+                                    queue_size=args.queue_size)
+    try:
+        converter.run()
+    except ValueError:
+        unknown = [name for name in converter.ordered_output if name not in (converter.available_fields or ())]
+        if not converter.available_fields or not unknown:
+            raise
+        parser.error("unknown output field(s) %s, this log provides: %s" % (','.join(unknown),
+                                                                             ','.join(converter.available_fields)))
+    print "Number of Errors %s" % converter.error_count
+    print "First pass success: %s" % converter.first_success
+    print "Rehash success: %s" % converter.rehash_success
     print "Elapsed time: %d" % (time.time() - start)
-    output_file.close()
+
 if __name__ == "__main__":
     main()
 
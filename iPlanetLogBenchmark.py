@@ -0,0 +1,304 @@
+__author__ = 'Jeffery.Smith'
+
+import os
+import sys
+import json
+import random
+import platform
+import argparse
+import tempfile
+import datetime
+import logging
+import multiprocessing
+import timeit
+import traceback
+import Queue
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import iPlanetLog
+
+FORMATS = {
+    'common' : 'format=%Ses->client.ip% - %Req->vars.auth-user% [%SYSDATE%] "%Req->reqpb.clf-request%" '
+               '%Req->srvhdrs.clf-status% %Req->srvhdrs.content-length%\n',
+    'combined' : 'format=%Ses->client.ip% - %Req->vars.auth-user% [%SYSDATE%] "%Req->reqpb.clf-request%" '
+                 '%Req->srvhdrs.clf-status% %Req->srvhdrs.content-length% "%Req->headers.referer%" '
+                 '"%Req->headers.user-agent%"\n',
+    'full' : 'format=%Ses->client.ip% - %Req->vars.auth-user% [%SYSDATE%] "%Req->reqpb.clf-request%" '
+             '%Req->srvhdrs.clf-status% %Req->srvhdrs.content-length% "%Req->headers.referer%" '
+             '"%Req->headers.user-agent%" %Req->headers.cookie% %Req->srvhdrs.content-type%\n',
+}
+
+
+class iPlanetLogGenerator(object):
+    #Writes a synthetic access log for any of the headers above (or one of your own built from the same fields).
+    #The same seed always produces the same file. The rates are the share of lines that get a user name with an
+    #embedded space (which sends the line through parse_by_field), a cookie a few KB long, a content type with a
+    #charset, or that are cut short / replaced with garbage.
+    USER_AGENTS = ('Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/535.2 (KHTML, like Gecko) Chrome/15.0.874.121',
+                   'Mozilla/4.0 (compatible; MSIE 8.0; Windows NT 5.1; Trident/4.0)',
+                   'Mozilla/5.0 (X11; Linux x86_64; rv:8.0) Gecko/20100101 Firefox/8.0',
+                   'Googlebot/2.1 (+http://www.google.com/bot.html)', 'curl/7.21.0')
+    REFERERS = ('-', 'http://www.example.com/', 'http://www.google.com/search?q=iplanet',
+                'http://intranet.example.com/portal/home.jsp')
+    METHODS = ('GET', 'GET', 'GET', 'POST', 'HEAD')
+    STATUSES = ('200', '200', '200', '200', '304', '302', '404', '500')
+    CONTENT_TYPES = ('text/html', 'image/gif', 'text/css', 'application/x-javascript', '-')
+
+    def __init__(self,header=FORMATS['full'],lines=100000,seed=0,embedded_delimiter_rate=0.0,long_cookie_rate=0.0,
+                 charset_rate=0.0,malformed_rate=0.0,start=datetime.datetime(2011,11,17)):
+        self.header = header
+        self.lines = lines
+        self.seed = seed
+        self.embedded_delimiter_rate = embedded_delimiter_rate
+        self.long_cookie_rate = long_cookie_rate
+        self.charset_rate = charset_rate
+        self.malformed_rate = malformed_rate
+        self.start = start
+        log_format = iPlanetLog.iPlanetLogFormat.from_header(header.replace("format=", ""))
+        self._fields = [(field, log_format.field_names.get(field.name)) for field in log_format.fields]
+
+    @property
+    def settings(self):
+        return {'header' : self.header, 'lines' : self.lines, 'seed' : self.seed,
+                'embedded_delimiter_rate' : self.embedded_delimiter_rate,
+                'long_cookie_rate' : self.long_cookie_rate, 'charset_rate' : self.charset_rate,
+                'malformed_rate' : self.malformed_rate}
+
+    def __iter__(self):
+        generator = random.Random(self.seed)
+        yield self.header
+        for number in xrange(self.lines):
+            line = self._line(generator, number)
+            if generator.random() < self.malformed_rate:
+                if generator.random() < 0.5:
+                    line = "%s\n" % line[:generator.randint(1, max(1, len(line) // 2))].rstrip("\n")
+                else:
+                    line = "%08x garbage written over the log\n" % generator.getrandbits(32)
+            yield line
+
+    def write(self,filename):
+        output = open(filename,'w')
+        output.writelines(self)
+        output.close()
+        return filename
+
+    def _line(self,generator,number):
+        #Roughly ten lines a second
+        when = self.start + datetime.timedelta(seconds=number // 10)
+        values = {'clientip' : "10.%d.%d.%d" % (generator.randint(0, 3), generator.randint(0, 255),
+                                                generator.randint(1, 254)),
+                  'user' : "-",
+                  '_datetime' : "%s -0500" % when.strftime("%d/%b/%Y:%H:%M:%S"),
+                  '_request_string' : "%s /app/page%d.jsp%s HTTP/1.1" % (generator.choice(self.METHODS),
+                                                                      generator.randint(0, 500),
+                                                                      "?id=%d" % number if number % 3 else ""),
+                  'status' : generator.choice(self.STATUSES),
+                  'content_length' : str(generator.randint(0, 50000)),
+                  'referer' : generator.choice(self.REFERERS),
+                  'user_agent' : generator.choice(self.USER_AGENTS),
+                  'cookies' : "JSESSIONID=%032x" % generator.getrandbits(128),
+                  'content_type' : generator.choice(self.CONTENT_TYPES)}
+        if generator.random() < self.embedded_delimiter_rate:
+            values['user'] = "john q%d smith" % generator.randint(0, 99)
+        if generator.random() < self.long_cookie_rate:
+            values['cookies'] = ";".join("c%d=%032x" % (cookie, generator.getrandbits(128))
+                                         for cookie in xrange(generator.randint(40, 120)))
+        if generator.random() < self.charset_rate:
+            values['content_type'] = "text/html; charset=UTF-8"
+        parts = []
+        for field, name in self._fields:
+            if field.isempty():
+                parts.append(" ")
+                continue
+            value = values.get(name, "-")
+            if field.start_delimiter:
+                parts.append("%s%s%s " % (field.start_delimiter, value, field.end_delimiter))
+            else:
+                parts.append("%s%s" % (value, field.end_delimiter))
+        return "%s\n" % ''.join(parts)
+
+
+def _iterate(filename):
+    log = iPlanetLog.iPlanetLogFile(open(filename,'rb'))
+    for record in log:
+        pass
+    return log
+
+def _iterate_mmap(filename):
+    log = iPlanetLog.iPlanetLogFile(open(filename,'rb'), use_mmap=True)
+    for record in log:
+        pass
+    return log
+
+def _batches(filename):
+    log = iPlanetLog.iPlanetLogFile(open(filename,'rb'))
+    for batch in log.batches(10000):
+        pass
+    return log
+
+def _stages(filename):
+    #Iterates with the stage timers on. The timer calls add their own overhead, so only the shares are worth
+    #comparing.
+    log = iPlanetLog.iPlanetLogFile(open(filename,'rb'), timing=True)
+    for record in log:
+        pass
+    return log
+
+SCENARIOS = {'iterate' : _iterate, 'mmap' : _iterate_mmap, 'batches' : _batches, 'stages' : _stages}
+
+
+def _run_scenario(name,filename,results):
+    #A scenario that raises is sent back as an error so the parent is never left waiting on the queue
+    try:
+        results.put(_measure_scenario(name, filename))
+    except Exception:
+        results.put({'error' : traceback.format_exc()})
+
+def _measure_scenario(name,filename):
+    logging.disable(logging.ERROR)
+    started = timeit.default_timer()
+    log = SCENARIOS[name](filename)
+    elapsed = timeit.default_timer() - started
+    result = {'seconds' : elapsed, 'first_success' : log.first_success, 'rehash_success' : log.rehash_success}
+    if resource is not None:
+        #ru_maxrss is in KB on Linux and bytes on Mac OS X
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result['peak_memory_kb'] = peak // 1024 if sys.platform == 'darwin' else peak
+    result['errors'] = log.stats.errors
+    measured = sum(log.stats.timers.values())
+    if measured:
+        result['stage_shares'] = dict((stage, seconds / measured) for stage, seconds in log.stats.timers.iteritems())
+    return result
+
+def _wait_for_result(worker,results):
+    #Also gives up on a worker that died without sending anything (killed, out of memory)
+    while True:
+        try:
+            return results.get(timeout=1)
+        except Queue.Empty:
+            if not worker.is_alive():
+                try:
+                    return results.get(timeout=1)
+                except Queue.Empty:
+                    return {'error' : "scenario process exited with code %s" % worker.exitcode}
+
+
+def run_benchmark(filename,scenarios=('iterate', 'mmap', 'batches', 'stages'),repeat=3):
+    #Each run happens in a fresh process so peak memory is measured per scenario. The fastest run is reported.
+    #A scenario that fails is reported with its error instead of timings.
+    size = os.path.getsize(filename)
+    lines = sum(1 for line in open(filename,'rb')) - 1
+    report = {}
+    for name in scenarios:
+        best = None
+        for attempt in xrange(repeat):
+            results = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=_run_scenario, args=(name, filename, results))
+            worker.start()
+            result = _wait_for_result(worker, results)
+            worker.join()
+            if 'error' in result:
+                best = result
+                break
+            if best is None or result['seconds'] < best['seconds']:
+                best = result
+        report[name] = best
+        if 'error' in best:
+            continue
+        best['lines_per_second'] = lines / best['seconds']
+        best['mb_per_second'] = size / best['seconds'] / (1024 * 1024)
+    return report
+
+
+def save_results(results_file,label,settings,report):
+    try:
+        history = json.load(open(results_file))
+    except (IOError, ValueError):
+        history = []
+    history.append({'label' : label, 'date' : datetime.datetime.now().isoformat(),
+                    'python' : platform.python_version(), 'platform' : platform.platform(),
+                    'settings' : settings, 'results' : report})
+    output = open(results_file,'w')
+    json.dump(history, output, indent=1, sort_keys=True)
+    output.close()
+    return history
+
+
+def print_report(label,report):
+    print "%s" % label
+    for name in sorted(report):
+        result = report[name]
+        if 'error' in result:
+            print "  %-8s failed: %s" % (name, result['error'].strip().splitlines()[-1])
+            continue
+        line = "  %-8s %10.0f lines/sec %8.2f MB/sec" % (name, result['lines_per_second'], result['mb_per_second'])
+        if 'peak_memory_kb' in result:
+            line += " %8d KB peak" % result['peak_memory_kb']
+        if 'stage_shares' in result:
+            line += " " + " / ".join("%s %.0f%%" % (stage.replace('_', ' '), result['stage_shares'][stage] * 100)
+                                     for stage in iPlanetLog.iPlanetLogStats.STAGES)
+        print line
+
+
+def compare(results_file):
+    #Lines/sec for every saved run, with the change against the first run that used the same settings
+    history = json.load(open(results_file))
+    baselines = {}
+    for run in history:
+        key = json.dumps(run['settings'], sort_keys=True)
+        baseline = baselines.setdefault(key, run)
+        print "%s (%s, python %s)" % (run['label'], run['date'], run['python'])
+        for name in sorted(run['results']):
+            if 'error' in run['results'][name]:
+                print "  %-8s failed" % name
+                continue
+            speed = run['results'][name]['lines_per_second']
+            try:
+                change = speed / baseline['results'][name]['lines_per_second'] - 1
+                print "  %-8s %10.0f lines/sec %+7.1f%% vs %s" % (name, speed, change * 100, baseline['label'])
+            except KeyError:
+                print "  %-8s %10.0f lines/sec" % (name, speed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the iPlanetLog parser on a synthetic access log.")
+    parser.add_argument('--format', choices=sorted(FORMATS), default='full', help="header format (default: full)")
+    parser.add_argument('--lines', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--embedded-delimiters', type=float, default=0.05,
+                        help="share of lines with a space inside a space delimited field")
+    parser.add_argument('--long-cookies', type=float, default=0.01)
+    parser.add_argument('--charset', type=float, default=0.1)
+    parser.add_argument('--malformed', type=float, default=0.001)
+    parser.add_argument('--scenarios', default='iterate,mmap,batches,stages')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--label', default=None, help="name for this run in the results file")
+    parser.add_argument('--output', default=None, help="JSON file the results are added to")
+    parser.add_argument('--compare', default=None, metavar='RESULTS', help="print a saved results file and exit")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(args.compare)
+        return
+    generator = iPlanetLogGenerator(FORMATS[args.format], lines=args.lines, seed=args.seed,
+                                    embedded_delimiter_rate=args.embedded_delimiters,
+                                    long_cookie_rate=args.long_cookies, charset_rate=args.charset,
+                                    malformed_rate=args.malformed)
+    handle, filename = tempfile.mkstemp(prefix='access.', suffix='.benchmark')
+    os.close(handle)
+    try:
+        generator.write(filename)
+        report = run_benchmark(filename, scenarios=args.scenarios.split(','), repeat=args.repeat)
+    finally:
+        os.remove(filename)
+    label = args.label or datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    print_report(label, report)
+    if args.output:
+        save_results(args.output, label, generator.settings, report)
+
+if __name__ == "__main__":
+    main()